@@ -20,13 +20,14 @@ from functools import wraps
 import glib
 import gobject
 import os
+import re
 import socket
 import sys
 from urllib import pathname2url, url2pathname
 from urlparse import urlsplit, urlunsplit
 
 from ..reference import PackageReference, BadReferenceError
-from ..util import ErrorBuffer, RangeConsolidator
+from ..util import ErrorBuffer
 
 class MachineExecutionError(Exception):
     pass
@@ -251,13 +252,20 @@ class ChunkStateArray(gobject.GObject):
     __gsignals__ = {
         'chunk-state-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
                 (gobject.TYPE_UINT64, gobject.TYPE_UINT64)),
+        # List of (first, last) ranges updated by one update_chunks() call
+        'chunk-ranges-changed': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+                (gobject.TYPE_PYOBJECT,)),
         'image-resized': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
                 (gobject.TYPE_UINT64,)),
     }
 
+    # state -> (translation table, changed-run regex)
+    _update_tables = {}
+
     def __init__(self):
         gobject.GObject.__init__(self)
-        self._chunks = []
+        # One byte per chunk rather than one boxed int
+        self._chunks = bytearray()
 
     def __len__(self):
         return len(self._chunks)
@@ -269,7 +277,7 @@ class ChunkStateArray(gobject.GObject):
         """Ensure the image is at least @chunks chunks long."""
         current = len(self._chunks)
         if chunks > current:
-            self._chunks.extend([self.MISSING] * (chunks - current))
+            self._chunks.extend(chr(self.MISSING) * (chunks - current))
             self.emit('image-resized', chunks)
             self.emit('chunk-state-changed', current, chunks - 1)
 
@@ -282,21 +290,43 @@ class ChunkStateArray(gobject.GObject):
         else:
             self._ensure_size(chunks)
 
+    @classmethod
+    def _get_update_table(cls, state):
+        """Return a translation table mapping each current chunk state to
+        its state after an update to @state, and a regex matching runs of
+        chunks changed by the update."""
+        try:
+            return cls._update_tables[state]
+        except KeyError:
+            pass
+        table = []
+        changed = []
+        for cur_state in xrange(256):
+            new_state = state
+            if ((cur_state == cls.ACCESSED and state == cls.MODIFIED) or
+                    (cur_state == cls.MODIFIED and state == cls.ACCESSED)):
+                new_state = cls.ACCESSED_MODIFIED
+            if cur_state < new_state:
+                table.append(chr(new_state))
+                changed.append(re.escape(chr(cur_state)))
+            else:
+                table.append(chr(cur_state))
+        ret = (''.join(table), re.compile('[%s]+' % ''.join(changed)))
+        cls._update_tables[state] = ret
+        return ret
+
     def update_chunks(self, state, first, last):
         # We may be notified of a chunk beyond the current EOF before we
         # are notified that the image has been resized.
         self._ensure_size(last + 1)
-        def emit(first, last):
-            self.emit('chunk-state-changed', first, last)
-        with RangeConsolidator(emit) as c:
-            for chunk in xrange(first, last + 1):
-                cur_state = self._chunks[chunk]
-                if ((cur_state == self.ACCESSED and
-                        state == self.MODIFIED) or
-                        (cur_state == self.MODIFIED and
-                        state == self.ACCESSED)):
-                    state = self.ACCESSED_MODIFIED
-                if cur_state < state:
-                    self._chunks[chunk] = state
-                    c.emit(chunk)
+        # Update the whole range with one translate() and find the runs
+        # of changed chunks with one regex scan.  Report all of the runs
+        # with a single signal.
+        table, changed = self._get_update_table(state)
+        chunks = self._chunks[first:last + 1]
+        self._chunks[first:last + 1] = chunks.translate(table)
+        ranges = [(first + match.start(), first + match.end() - 1)
+                for match in changed.finditer(chunks)]
+        if ranges:
+            self.emit('chunk-ranges-changed', ranges)
 gobject.type_register(ChunkStateArray)
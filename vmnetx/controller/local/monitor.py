@@ -35,31 +35,35 @@ class StatMonitor(_Monitor):
         _Monitor.__init__(self)
         self._reporter = reporter
         self._path = os.path.join(image_path, 'stats', name)
-        self._fh = None
+        self._fd = None
         self._source = None
         self._read()
 
     def _read(self):
+        # vmnetfs reports a change by making the open file readable, so we
+        # have to reopen the file to wait for the next one.  Use a bare fd
+        # rather than a file object, since we only ever read one value.
         try:
-            self._fh = io.open(self._path)
-        except IOError:
+            self._fd = os.open(self._path, os.O_RDONLY)
+        except OSError:
             # Stop accessing this stat
             return
-        value = int(self._fh.readline().strip())
+        value = int(os.read(self._fd, 32).strip())
         if value != self._reporter.value:
             self._reporter.value = value
-        self._source = glib.io_add_watch(self._fh, glib.IO_IN | glib.IO_ERR,
+        self._source = glib.io_add_watch(self._fd, glib.IO_IN | glib.IO_ERR,
                 self._reread)
 
-    def _reread(self, _fh, _condition):
+    def _reread(self, _fd, _condition):
         self.close()
         self._read()
         return True
 
     def close(self):
-        if self._fh and not self._fh.closed:
+        if self._fd is not None:
             glib.source_remove(self._source)
-            self._fh.close()
+            os.close(self._fd)
+            self._fd = None
 gobject.type_register(StatMonitor)
 
 
@@ -71,7 +75,7 @@ class _StreamMonitorBase(_Monitor):
         self._fh = io.FileIO(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
         self._source = glib.io_add_watch(self._fh, glib.IO_IN | glib.IO_ERR,
                 self._read)
-        self._buf = ''
+        self._buf = bytearray()
         # Defer initial update until next main loop iteration, to allow the
         # caller to connect to our signal
 
@@ -89,11 +93,14 @@ class _StreamMonitorBase(_Monitor):
             return False
         elif buf is not None:
             # We got some output
-            lines = (self._buf + buf).split('\n')
-            # Save partial last line, if any
-            self._buf = lines.pop()
-            # Process lines
-            self._handle_lines(lines)
+            self._buf.extend(buf)
+            end = self._buf.rfind('\n')
+            if end >= 0:
+                lines = str(self._buf[:end]).split('\n')
+                # Keep partial last line, if any
+                del self._buf[:end + 1]
+                # Process lines
+                self._handle_lines(lines)
         return True
 
     def _handle_lines(self, lines):
@@ -127,8 +134,7 @@ class _ChunkStreamMonitor(_StreamMonitorBase):
         def emit_range(first, last):
             self.emit('chunk-emitted', first, last)
         with RangeConsolidator(emit_range) as c:
-            for line in lines:
-                c.emit(int(line))
+            c.emit_many(map(int, lines))
 gobject.type_register(_ChunkStreamMonitor)
 
 
@@ -182,9 +188,11 @@ class LoadProgressMonitor(_Monitor):
         self._stream.connect('chunk-emitted', self._progress)
 
     def _read_stat(self, image_path, name):
-        path = os.path.join(image_path, 'stats', name)
-        with io.open(path) as fh:
-            return int(fh.readline().strip())
+        fd = os.open(os.path.join(image_path, 'stats', name), os.O_RDONLY)
+        try:
+            return int(os.read(fd, 32).strip())
+        finally:
+            os.close(fd)
 
     def _progress(self, _monitor, first, last):
         # We don't keep a bitmap of previously-seen chunks, because we
@@ -307,7 +307,14 @@ gobject.type_register(_Endpoint)
 
 
 class ServerEndpoint(_Endpoint):
+    # 'message' is emitted for every client request with the message type
+    # and a tuple of arguments.  If no handler returns True, the
+    # type-specific signal is emitted with those arguments.  This lets a
+    # consumer handle every request with one connection.
     __gsignals__ = {
+        'message': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_BOOLEAN,
+                (gobject.TYPE_STRING, gobject.TYPE_PYOBJECT),
+                gobject.signal_accumulator_true_handled),
         'authenticate': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_BOOLEAN,
                 (gobject.TYPE_STRING,),
                 gobject.signal_accumulator_true_handled),
@@ -335,6 +342,9 @@ class ServerEndpoint(_Endpoint):
     do_stop_vm = _fail_if_not_handled
     do_destroy_vm = _fail_if_not_handled
 
+    def do_message(self, mtype, args):
+        self.emit(mtype, *args)
+
     def _need_auth(self):
         if not self._authenticated:
             raise _MessageError('Not authenticated')
@@ -342,31 +352,23 @@ class ServerEndpoint(_Endpoint):
     def _dispatch(self, mtype, msg):
         try:
             if mtype == 'authenticate':
-                self.emit('authenticate', msg['token'])
+                args = (msg['token'],)
 
-            elif mtype == 'attach-viewer':
+            elif mtype in ('attach-viewer', 'start-vm', 'stop-vm',
+                    'destroy-vm'):
                 self._need_auth()
-                self.emit('attach-viewer')
-
-            elif mtype == 'start-vm':
-                self._need_auth()
-                self.emit('start-vm')
-
-            elif mtype == 'stop-vm':
-                self._need_auth()
-                self.emit('stop-vm')
-
-            elif mtype == 'destroy-vm':
-                self._need_auth()
-                self.emit('destroy-vm')
+                args = ()
 
             elif mtype == 'ping':
                 self._need_auth()
                 self._transmit('pong')
-                self.emit('ping')
+                args = ()
 
             else:
                 _Endpoint._dispatch(self, mtype, msg)
+                return
+
+            self.emit('message', mtype, args)
 
         except KeyError, e:
             raise _MessageError('Missing field in %s message: %s' % (mtype, e))
@@ -23,46 +23,119 @@ import errno
 from functools import partial
 import glib
 import gobject
+import heapq
 import logging
 import os
 import socket
-from threading import Thread, Lock, Event
+from threading import Thread, Lock
 import time
+import weakref
 
 from .http import HttpServer, ServerUnavailableError
 from ..controller import Controller, MachineExecutionError, MachineStateError
 from ..controller.local import LocalController
 from ..protocol import ServerEndpoint
+from ..util import connect_signals, disconnect_signals
 
 _log = logging.getLogger(__name__)
 
+# Controller state -> name reported by the web API
+_STATE_NAMES = {
+    LocalController.STATE_UNINITIALIZED: 'uninitialized',
+    LocalController.STATE_STOPPED: 'stopped',
+    LocalController.STATE_STARTING: 'starting',
+    LocalController.STATE_RUNNING: 'running',
+    LocalController.STATE_STOPPING: 'stopping',
+    LocalController.STATE_DESTROYED: 'destroyed',
+}
+
+# Controller state -> name sent to clients; others are sent as 'unknown'
+_PROTOCOL_STATE_NAMES = {
+    LocalController.STATE_STOPPED: 'stopped',
+    LocalController.STATE_STARTING: 'starting',
+    LocalController.STATE_RUNNING: 'running',
+    LocalController.STATE_STOPPING: 'stopping',
+}
+
+
+class _Timestamp(object):
+    '''A mutable time value which can be shared between objects.'''
+
+    __slots__ = ('time',)
+
+    def __init__(self, value):
+        self.time = value
+
+
+class _TokenPool(object):
+    '''Thread-safe supply of random tokens.  Random bytes are read and
+    encoded in bulk, then sliced into tokens.  nbytes must be a multiple
+    of the encoding's block size so that no padding appears and token
+    boundaries line up.'''
+
+    def __init__(self, encode, nbytes, count=256):
+        self._encode = encode
+        self._nbytes = nbytes
+        self._count = count
+        self._lock = Lock()
+        self._tokens = []
+
+    def get(self):
+        with self._lock:
+            if not self._tokens:
+                data = self._encode(os.urandom(self._nbytes * self._count))
+                width = len(data) // self._count
+                assert width * self._count == len(data)
+                self._tokens = [data[i:i + width]
+                        for i in xrange(0, len(data), width)]
+            return self._tokens.pop()
+
 
 class _ServerConnection(gobject.GObject):
     __gsignals__ = {
-        'need-controller': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_BOOLEAN,
-                (gobject.TYPE_STRING,)),
-        'ping': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
         'close': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
-        'destroy-instance': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
-    def __init__(self, sock, timeout_min, timeout_max):
+    PROGRESS_INTERVAL = 0.05  # seconds
+
+    # Controller signals forwarded to the client.  Each is handled by the
+    # method named _ctrl_<signal name with underscores>.
+    CONTROLLER_SIGNALS = ('startup-progress', 'startup-rejected-memory',
+            'startup-failed', 'vm-started', 'vm-stopped')
+
+    def __init__(self, sock, peer, timeout_min, timeout_max,
+            fetch_controller):
+        # fetch_controller(conn, token) is called when the client
+        # authenticates.  It must arrange for set_controller() or
+        # fail_controller() to be called.
         gobject.GObject.__init__(self)
+        self._fetch_controller = fetch_controller
         self._timeout_min = timeout_min
         self._timeout_max = timeout_max
-        self._peer = sock.getpeername()[0]
+        self._peer = peer
         self._controller = None
         self._instance_id = None
+        # Set by set_instance()
+        self._instance = None
+        self._last_seen = None
         self._endp = ServerEndpoint(sock)
-        self._endp.connect('authenticate', self._client_authenticate)
-        self._endp.connect('attach-viewer', self._client_attach_viewer)
-        self._endp.connect('start-vm', self._client_start_vm)
-        self._endp.connect('stop-vm', self._client_stop_vm)
-        self._endp.connect('destroy-vm', self._client_destroy_vm)
-        self._endp.connect('ping', self._client_ping)
+        self._endp.connect('message', self._client_message)
         self._endp.connect('error', self._client_error)
         self._endp.connect('close', self._client_shutdown)
-        self._controller_sources = []
+        self._controller_sources = ()
+        self._last_progress_percent = None
+        self._last_progress_time = 0
+
+    @property
+    def peer(self):
+        return self._peer
+
+    def set_instance(self, instance, last_seen):
+        '''Called by the _Instance adopting this connection.  We report
+        to it directly rather than through signals.  last_seen is a
+        _Timestamp updated on every ping.'''
+        self._instance = instance
+        self._last_seen = last_seen
 
     def shutdown(self):
         self._endp.shutdown()
@@ -76,12 +149,21 @@ class _ServerConnection(gobject.GObject):
                 pass
         self.shutdown()
 
+    def _client_message(self, endp, mtype, args):
+        # Each message type is handled by the method named
+        # _client_<type with underscores>
+        handler = getattr(self, '_client_' + mtype.replace('-', '_'), None)
+        if handler is None:
+            return False
+        handler(endp, *args)
+        return True
+
     def _client_authenticate(self, _endp, token):
         if self._controller is not None:
             self._endp.send_error('Already authenticated')
             return True
 
-        self.emit('need-controller', token)
+        self._fetch_controller(self, token)
         return True
 
     def fail_controller(self):
@@ -99,21 +181,11 @@ class _ServerConnection(gobject.GObject):
         # Now we can start forwarding controller signals.  We disconnect
         # from the controller at shutdown to avoid leaking _ServerConnection
         # objects.
-        def connect(signal, handler):
-            source = self._controller.connect(signal, handler)
-            self._controller_sources.append(source)
-        connect('startup-progress', self._ctrl_startup_progress)
-        connect('startup-rejected-memory', self._ctrl_startup_rejected_memory)
-        connect('startup-failed', self._ctrl_startup_failed)
-        connect('vm-started', self._ctrl_vm_started)
-        connect('vm-stopped', self._ctrl_vm_stopped)
-
-        cs = self._controller.state
-        state = ('stopped' if cs == LocalController.STATE_STOPPED else
-                'starting' if cs == LocalController.STATE_STARTING else
-                'running' if cs == LocalController.STATE_RUNNING else
-                'stopping' if cs == LocalController.STATE_STOPPING else
-                'unknown')
+        self._controller_sources = connect_signals(self._controller,
+                ((signal, getattr(self, '_ctrl_' + signal.replace('-', '_')))
+                for signal in self.CONTROLLER_SIGNALS))
+
+        state = _PROTOCOL_STATE_NAMES.get(self._controller.state, 'unknown')
         self._endp.send_auth_ok(state, self._controller.vm_name,
                 self._controller.max_mouse_rate, self._timeout_min,
                 self._timeout_max)
@@ -154,12 +226,14 @@ class _ServerConnection(gobject.GObject):
         return True
 
     def _client_destroy_vm(self, _endp):
-        self.emit('destroy-instance')
+        if self._instance is not None:
+            self._instance.shutdown()
         _log.info('Destroying VM (%s, %s)', self._peer, self._instance_id)
         return True
 
     def _client_ping(self, _endp):
-        self.emit('ping')
+        if self._last_seen is not None:
+            self._last_seen.time = time.time()
 
     def _client_error(self, _endp, message):
         _log.warning("Protocol error: %s (%s, %s)", message, self._peer,
@@ -167,16 +241,27 @@ class _ServerConnection(gobject.GObject):
         self.shutdown()
 
     def _disconnect_controller(self):
-        for source in self._controller_sources:
-            self._controller.disconnect(source)
-        self._controller_sources = []
+        disconnect_signals(self._controller, self._controller_sources)
+        self._controller_sources = ()
 
     def _client_shutdown(self, _endp):
         self._disconnect_controller()
+        if self._instance is not None:
+            instance = self._instance
+            self._instance = None
+            instance.remove_connection(self)
         self.emit('close')
 
     def _ctrl_startup_progress(self, _obj, count, total):
-        self._endp.send_startup_progress(count / total)
+        # Forward at most one update per percentage point and per
+        # PROGRESS_INTERVAL, but always forward completion.
+        percent = count * 100 // total
+        now = time.time()
+        if count == total or (percent != self._last_progress_percent and
+                now - self._last_progress_time >= self.PROGRESS_INTERVAL):
+            self._last_progress_percent = percent
+            self._last_progress_time = now
+            self._endp.send_startup_progress(count / total)
 
     def _ctrl_startup_rejected_memory(self, _obj):
         self._endp.send_startup_rejected_memory()
@@ -240,49 +325,55 @@ class _WorkerThreadFuture(object):
                 self._callbacks.append(callback)
 
 
-class _Instance(gobject.GObject):
-    __gsignals__ = {
-        'destroy': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
-    }
-
-    def __init__(self, package, username, password, user_ident):
-        # Called from HTTP worker thread
-        gobject.GObject.__init__(self)
-        self.id = base64.b32encode(os.urandom(10))
-        self.authcode = base64.urlsafe_b64encode(os.urandom(15))
+class _Instance(object):
+    def __init__(self, id, authcode, package, username, password,
+            user_ident, destroy_callback):
+        # Called from event loop thread
+        # destroy_callback(instance) is called once the instance has been
+        # shut down and all of its connections have closed.
+        self.id = id
+        self.authcode = authcode
         self.token = '%s/%s' % (self.id, self.authcode)
         self._package = package
         self._username = username
         self._password = password
         self._controller_future = None
+        # True while the controller future is running
+        self._controller_pending = False
         self._controller = None
-        self._conns = set()
+        # Weak, like VMNetXServer._unauthenticated_conns.  Used as a set.
+        self._conns = weakref.WeakKeyDictionary()
         self._valid = True
         self._destroyed = False
+        self._destroy_callback = destroy_callback
         self.user_ident = user_ident
-        self.last_seen = time.time()
+        self._last_seen = _Timestamp(time.time())
 
     def add_connection(self, conn):
         if not self._valid:
             raise ValueError('Instance already shut down')
 
-        self.last_seen = time.time()
-        self._conns.add(conn)
-        conn.connect('ping', self._update_last_seen)
-        conn.connect('close', self._close)
-        conn.connect('destroy-instance', lambda _conn: self.shutdown())
+        self._last_seen.time = time.time()
+        self._conns[conn] = True
+        conn.set_instance(self, self._last_seen)
 
         if self._controller is not None:
             conn.set_controller(self._controller, self.id)
         else:
             # Wait for controller to be initialized
-            if self._controller_future is None:
-                # and start a thread to do so
-                self._controller_future = _WorkerThreadFuture(
-                        self._get_controller_worker)
+            self.prewarm()
             self._controller_future.get(partial(self._get_controller_result,
                     conn))
 
+    def prewarm(self):
+        '''Start initializing the controller, if we haven't already, so
+        that it is ready by the time the client connects.'''
+        if self._controller_future is None:
+            self._controller_pending = True
+            self._controller_future = _WorkerThreadFuture(
+                    self._get_controller_worker)
+            self._controller_future.get(self._controller_ready)
+
     def _get_controller_worker(self):
         # Runs in worker thread
         assert self._controller is None
@@ -297,51 +388,52 @@ class _Instance(gobject.GObject):
             _log.exception('Failed to initialize controller (%s)', self.id)
             raise
 
+    def _controller_ready(self, result=None, exception=None):
+        # Registered before any connection callbacks, so it runs first
+        self._controller_pending = False
+        if self._destroyed:
+            # _try_destroy() was waiting for us
+            if exception is not None:
+                self._destroy_callback(self)
+            else:
+                future = _WorkerThreadFuture(result.shutdown)
+                future.get(self._controller_shutdown_finished)
+            return
+        if exception is not None:
+            return
+        self._controller = result
+
     def _get_controller_result(self, conn, result=None, exception=None):
         if exception is not None:
             conn.fail_controller()
             return
-        controller = result
         if self._destroyed:
-            # Lost the race: we've already completed destruction
-            _WorkerThreadFuture(controller.shutdown)
             return
-        if self._controller is None:
-            self._controller = controller
-        conn.set_controller(controller, self.id)
+        conn.set_controller(result, self.id)
 
     @property
     def status(self):
-        if self._controller is None:
+        # May be called from HTTP worker thread
+        controller = self._controller
+        if controller is None:
             if self._destroyed:
                 return 'terminating'
             elif self._controller_future is not None:
                 return 'initializing'
             else:
                 return 'pending'
-        state = self._controller.state
-        if state == LocalController.STATE_UNINITIALIZED:
-            return "uninitialized"
-        elif state == LocalController.STATE_STOPPED:
-            return "stopped"
-        elif state == LocalController.STATE_STARTING:
-            return "starting"
-        elif state == LocalController.STATE_RUNNING:
-            return "running"
-        elif state == LocalController.STATE_STOPPING:
-            return "stopping"
-        elif state == LocalController.STATE_DESTROYED:
-            return "destroyed"
+        return _STATE_NAMES.get(controller.state)
 
     @property
     def vm_name(self):
         return self._package.name
 
-    def _update_last_seen(self, _conn):
-        self.last_seen = time.time()
+    @property
+    def last_seen(self):
+        return self._last_seen.time
 
-    def _close(self, conn):
-        self._conns.remove(conn)
+    def remove_connection(self, conn):
+        self._conns.pop(conn, None)
         self._try_destroy()
 
     def _try_destroy(self):
@@ -353,29 +445,32 @@ class _Instance(gobject.GObject):
                 self._controller = None
                 future = _WorkerThreadFuture(controller.shutdown)
                 future.get(self._controller_shutdown_finished)
-            else:
-                self.emit('destroy')
+            elif not self._controller_pending:
+                self._destroy_callback(self)
+            # Otherwise _controller_ready() shuts down the controller
+            # once it has been initialized, so the server doesn't exit
+            # with vmnetfs still running
 
     # Unused keyword arguments
     # pylint: disable=unused-argument
     def _controller_shutdown_finished(self, result=None, exception=None):
-        self.emit('destroy')
+        self._destroy_callback(self)
     # pylint: enable=unused-argument
 
     def shutdown(self):
         if self._valid:
             self._valid = False
-            conns = list(self._conns)
+            conns = self._conns.keys()
             for conn in conns:
                 conn.destroy()
             self._try_destroy()
-gobject.type_register(_Instance)
 
 
 class _MainLoopFuture(object):
     def __init__(self, func, *args, **kwargs):
         # Called from HTTP worker thread
-        self._event = Event()
+        # Completion is signaled by writing a byte to a pipe
+        self._read_fd, self._write_fd = os.pipe()
         self._result = None
         self._exception = None
         self._func = func
@@ -391,14 +486,24 @@ class _MainLoopFuture(object):
             self._result = self._func(*self._args, **self._kwargs)
         except Exception, e:
             self._exception = e
-        self._event.set()
+        os.write(self._write_fd, '\0')
+        os.close(self._write_fd)
     # pylint: enable=broad-except
 
     # pylint thinks we're raising None, but we explicitly check for this
     # pylint: disable=raising-bad-type
     def get(self):
         # Called from HTTP worker thread
-        self._event.wait()
+        try:
+            while True:
+                try:
+                    os.read(self._read_fd, 1)
+                    break
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+        finally:
+            os.close(self._read_fd)
         if self._exception is not None:
             raise self._exception
         return self._result
@@ -410,16 +515,38 @@ class VMNetXServer(gobject.GObject):
         'shutdown': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
+    # Refuse authentication attempts from a peer against an instance after
+    # this many failures within AUTH_FAILURE_WINDOW
+    AUTH_FAILURE_LIMIT = 10
+    AUTH_FAILURE_WINDOW = 60  # seconds
+    DEFER_ACCEPT_TIMEOUT = 5  # seconds
+    KEEPALIVE_IDLE = 30  # seconds
+
     def __init__(self, options):
         gobject.threads_init()
         gobject.GObject.__init__(self)
         self._options = options
-        self._instances = {}  # id -> _Instance
+        # id -> _Instance.  Copy-on-write: only the event loop thread
+        # modifies it, by replacing the whole dict, so HTTP threads can
+        # read a snapshot without synchronization.
+        self._instances = {}
+        # Heap of (expiration time, instance id).  Entries may be stale;
+        # _gc rechecks last_seen before expiring anything.
+        self._expiry = []
         self._http = None
-        self._unauthenticated_conns = set()
+        # Weak, so a connection that is dropped without emitting 'close'
+        # can still be freed.  Used as a set; the values are unused.
+        self._unauthenticated_conns = weakref.WeakKeyDictionary()
+        # (peer, instance id or None) -> (count, window start time).
+        # Failures naming unknown instances share the None key, so guessed
+        # ids can't grow the dict without bound.
+        self._auth_failures = {}
+        self._instance_ids = _TokenPool(base64.b32encode, 10)
+        self._authcodes = _TokenPool(base64.urlsafe_b64encode, 15)
         self._listen = None
         self._listen_source = None
         self._gc_timer = None
+        self._gc_deadline = None
         self._shutting_down = False
         self.running = False
 
@@ -430,8 +557,9 @@ class VMNetXServer(gobject.GObject):
         http_server = HttpServer(self._options, self)
         host = self._options['http_host']
         port = self._options['http_port']
-        self._http = Thread(target=http_server.run,
-                kwargs={"host": host, "port": port, "threaded": True})
+        threads = self._options['http_threads']
+        self._http = Thread(target=http_server.serve,
+                kwargs={"host": host, "port": port, "threads": threads})
         # The http server should exit when the main thread terminates
         self._http.daemon = True
         self._http.start()
@@ -439,38 +567,51 @@ class VMNetXServer(gobject.GObject):
         self._listen = socket.socket()
         self._listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._listen.bind((self._options['host'], self._options['port']))
-        self._listen.listen(16)
+        self._set_listen_options(self._listen)
+        # Let the kernel queue bursts of connections while the event loop
+        # is busy
+        self._listen.listen(socket.SOMAXCONN)
         self._listen.setblocking(0)
         self._listen_source = glib.io_add_watch(self._listen, glib.IO_IN,
                 self._accept)
 
-        # Start garbage collection
-        self._gc_timer = glib.timeout_add_seconds(self._options['gc_interval'],
-                self._gc)
-
         self.running = True
 
+    def _set_listen_options(self, sock):
+        # Clients always speak first, so don't wake up until they do.
+        # Accepted sockets inherit the keepalive settings, which detect
+        # dead peers without relying on pings.  TCP_NODELAY is set by
+        # _AsyncSocket.  The TCP_* options are Linux-specific.
+        if hasattr(socket, 'TCP_DEFER_ACCEPT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT,
+                    self.DEFER_ACCEPT_TIMEOUT)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                    self.KEEPALIVE_IDLE)
+
     def _accept(self, _source, _cond):
+        # Drain the accept queue in one wakeup
         while True:
             try:
-                sock, _addr = self._listen.accept()
+                sock, addr = self._listen.accept()
             except socket.error, e:
                 if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
                     return True
+                elif e.errno in (errno.EINTR, errno.ECONNABORTED):
+                    continue
                 else:
                     _log.exception('Accepting connection')
+                    return True
             timeout = self._options['instance_timeout']
-            conn = _ServerConnection(sock, timeout,
-                    timeout + self._options['gc_interval'])
-            conn.connect('need-controller', self._fetch_controller)
+            conn = _ServerConnection(sock, addr[0], timeout,
+                    timeout + self._options['gc_interval'],
+                    self._fetch_controller)
             conn.connect('close', self._close)
-            self._unauthenticated_conns.add(conn)
+            self._unauthenticated_conns[conn] = True
 
     def _close(self, conn):
-        try:
-            self._unauthenticated_conns.remove(conn)
-        except KeyError:
-            pass
+        self._unauthenticated_conns.pop(conn, None)
         self._check_shutdown()
 
     def _fetch_controller(self, conn, token):
@@ -478,45 +619,80 @@ class VMNetXServer(gobject.GObject):
 
         try:
             id, authcode = token.split('/', 1)
-            instance = self._instances[id]
-            if instance.authcode != authcode:
-                raise KeyError
-        except (KeyError, ValueError):
+        except ValueError:
+            id, authcode = None, None
+        instance = self._instances.get(id)
+        key = (conn.peer, id if instance is not None else None)
+        if self._auth_throttled(key):
+            # Too many recent failures; don't even check the authcode
+            instance = None
+        elif instance is None or instance.authcode != authcode:
+            self._record_auth_failure(key)
+            instance = None
+        if instance is None:
             conn.fail_controller()
+            # Don't keep the connection around for further guesses.  The
+            # socket is closed once the auth-failed message is sent.
+            conn.shutdown()
             return
 
         instance.add_connection(conn)
-        self._unauthenticated_conns.remove(conn)
+        del self._unauthenticated_conns[conn]
+
+    def _record_auth_failure(self, key):
+        now = time.time()
+        count, start = self._auth_failures.get(key, (0, now))
+        if now - start > self.AUTH_FAILURE_WINDOW:
+            count, start = 0, now
+        self._auth_failures[key] = (count + 1, start)
+        self._schedule_gc()
+
+    def _auth_throttled(self, key):
+        try:
+            count, start = self._auth_failures[key]
+        except KeyError:
+            return False
+        return (count >= self.AUTH_FAILURE_LIMIT and
+                time.time() - start <= self.AUTH_FAILURE_WINDOW)
 
     def create_instance(self, package, user_ident):
         # Called from HTTP worker thread
         if not self.running:
             raise ServerUnavailableError()
-        return _MainLoopFuture(self._create_instance, package,
+        # Read from the RNG here rather than stalling the event loop
+        id = self._instance_ids.get()
+        authcode = self._authcodes.get()
+        return _MainLoopFuture(self._create_instance, id, authcode, package,
                 user_ident).get()
 
-    def _create_instance(self, package, user_ident):
+    def _create_instance(self, id, authcode, package, user_ident):
         # Called from event loop thread
-        instance = _Instance(package, self._options['username'],
-                self._options['password'], user_ident)
-        self._instances[instance.id] = instance
-        instance.connect('destroy', self._destroy_instance_cb)
+        instance = _Instance(id, authcode, package, self._options['username'],
+                self._options['password'], user_ident,
+                self._destroy_instance_cb)
+        instances = dict(self._instances)
+        instances[instance.id] = instance
+        self._instances = instances
+        heapq.heappush(self._expiry, (self._expiration(instance),
+                instance.id))
+        self._schedule_gc()
+        instance.prewarm()
         return (instance.id, instance.token)
 
     def _destroy_instance_cb(self, instance):
-        del self._instances[instance.id]
+        instances = dict(self._instances)
+        del instances[instance.id]
+        self._instances = instances
         self._check_shutdown()
 
     def get_status(self):
         # Called from HTTP worker thread
         if not self.running:
             raise ServerUnavailableError()
-        return _MainLoopFuture(self._get_status).get()
-
-    def _get_status(self):
-        # Called from event loop thread
+        # Read a snapshot rather than waiting for the event loop.  The
+        # fields we read are each updated atomically.
         instances = []
-        for instance in self._instances.values():
+        for instance in self._instances.itervalues():
             instances.append({
                 "id": instance.id,
                 "vm_name": instance.vm_name,
@@ -537,18 +713,69 @@ class VMNetXServer(gobject.GObject):
         # Called from event loop thread
         self._instances[instance_id].shutdown()
 
+    def _expiration(self, instance):
+        return (instance.last_seen + self._options['gc_interval'] +
+                self._options['instance_timeout'])
+
+    def _schedule_gc(self):
+        # Only wake up when something can expire: the earliest instance
+        # deadline or authentication failure window.  Authentication
+        # failures expire much sooner than instances, so a new deadline
+        # can be earlier than the one the timer is armed for; re-arm the
+        # timer in that case.
+        if not self.running:
+            return
+        deadlines = []
+        if self._expiry:
+            deadlines.append(self._expiry[0][0])
+        if self._auth_failures:
+            deadlines.append(min(start for _count, start in
+                    self._auth_failures.itervalues()) +
+                    self.AUTH_FAILURE_WINDOW)
+        if not deadlines:
+            return
+        deadline = min(deadlines)
+        if self._gc_timer is not None:
+            if self._gc_deadline <= deadline:
+                return
+            glib.source_remove(self._gc_timer)
+        # _gc expires strictly after the deadline
+        delay = max(int(deadline - time.time()), 0) + 1
+        self._gc_timer = glib.timeout_add_seconds(delay, self._gc)
+        self._gc_deadline = deadline
+
     def _gc(self):
-        gc = self._options['gc_interval']
-        to = self._options['instance_timeout']
+        self._gc_timer = None
         # All garbage collection is done with relation to a single start time
         curr = time.time()
-        instances = self._instances.values()
-        for instance in instances:
-            # Check if the instance has not timed out since the last gc call
-            if curr > instance.last_seen + gc + to:
-                _log.debug('GC: Removing instance %s', instance.id)
-                instance.shutdown()
-        return True
+        # Only look at instances whose last known expiration time has
+        # passed.  Pings don't touch the heap, so an instance that has been
+        # seen since its entry was pushed is reinserted with its new
+        # expiration time.  Finish updating the heap before shutting
+        # anything down, since shutdown() can call back into the server.
+        expiry = self._expiry
+        instances = self._instances
+        expired = []
+        while expiry and curr > expiry[0][0]:
+            _deadline, id = heapq.heappop(expiry)
+            instance = instances.get(id)
+            if instance is None:
+                # Already destroyed
+                continue
+            deadline = self._expiration(instance)
+            if curr > deadline:
+                expired.append(instance)
+            else:
+                heapq.heappush(expiry, (deadline, id))
+        for instance in expired:
+            _log.debug('GC: Removing instance %s', instance.id)
+            instance.shutdown()
+        # Forget authentication failures from expired windows
+        for key, (_count, start) in self._auth_failures.items():
+            if curr - start > self.AUTH_FAILURE_WINDOW:
+                del self._auth_failures[key]
+        self._schedule_gc()
+        return False
 
     def shutdown(self):
         # Does not shut down web server, since there's no API for doing so
@@ -567,7 +794,7 @@ class VMNetXServer(gobject.GObject):
         instances = self._instances.values()
         for instance in instances:
             instance.shutdown()
-        conns = list(self._unauthenticated_conns)
+        conns = self._unauthenticated_conns.keys()
         for conn in conns:
             conn.shutdown()
         self._check_shutdown()
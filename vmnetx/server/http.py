@@ -20,8 +20,21 @@ from dateutil.tz import tzutc
 from flask import Flask, Response, request, jsonify
 from functools import wraps
 import json
+try:
+    from hmac import compare_digest as _compare_digest
+except ImportError:
+    _compare_digest = None
+try:
+    # Faster, if available
+    from ujson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import logging
+import Queue
+from threading import Thread, Lock
+import time
 from urlparse import urlunsplit
+from werkzeug.serving import BaseWSGIServer
 
 from ..package import Package
 from ..source import source_open
@@ -30,23 +43,95 @@ from ..util import NeedAuthentication
 _log = logging.getLogger(__name__)
 
 DEFAULT_PORT = 18923
+DEFAULT_THREADS = 8
+PACKAGE_CACHE_SIZE = 64
+PACKAGE_CACHE_TTL = 60  # seconds
+
+# Fixed-shape response body for instance creation
+_CREATE_RESPONSE = '{"url": %s, "id": %s}'
 
 
 class ServerUnavailableError(Exception):
     pass
 
 
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _keys_equal(a, b):
+    '''Compare two strings in time independent of their contents.'''
+    if _compare_digest is not None:
+        return _compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class _PooledWSGIServer(BaseWSGIServer):
+    '''A WSGI server which handles requests on a fixed set of worker
+    threads rather than starting a thread per request.'''
+
+    # Tell the application that requests run concurrently
+    multithread = True
+
+    def __init__(self, host, port, app, threads):
+        BaseWSGIServer.__init__(self, host, port, app)
+        self._requests = Queue.Queue()
+        for _ in xrange(threads):
+            thread = Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        # Called from accept thread
+        self._requests.put((request, client_address))
+
+    # We intentionally catch most exceptions
+    # pylint: disable=broad-except
+    def _worker(self):
+        # Called from worker thread
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                # As in ThreadingMixIn, shut the socket down before
+                # closing it
+                self.shutdown_request(request)
+    # pylint: enable=broad-except
+
+
 class HttpServer(Flask):
     def __init__(self, options, server):
         Flask.__init__(self, __name__)
         self._options = options
         self._server = server
-        self.add_url_rule('/instance', 'status', self._status)
-        self.add_url_rule('/instance', 'create-instance',
-                self._create_instance, methods=['POST'])
+        self._secret_key = _to_bytes(options['secret_key'])
+        # Packages are read-only once loaded, so instances created from
+        # the same URL can share one
+        self._package_lock = Lock()
+        self._package_cache = {}  # url -> (Package, load time)
+
+        hostname = options['host']
+        if options['port'] != DEFAULT_PORT:
+            hostname += ':%d' % options['port']
+        self._url_prefix = urlunsplit(('vmnetx', hostname, '/', '', ''))
+        self.add_url_rule('/instance', 'instance', self._instance,
+                methods=['GET', 'POST'])
         self.add_url_rule('/instance/<instance_id>', 'destroy-instance',
                 self._destroy_instance, methods=['DELETE'])
 
+    def serve(self, host, port, threads=DEFAULT_THREADS):
+        _PooledWSGIServer(host, port, self, threads).serve_forever()
+
     # We are a decorator, accessing protected members of our own class
     # pylint: disable=no-self-argument,protected-access
     def _check_running(func):
@@ -70,12 +155,18 @@ class HttpServer(Flask):
                 secret_key = request.headers['X-Secret-Key']
             except KeyError:
                 return Response('Missing secret key', 403)
-            if secret_key != self._options['secret_key']:
+            if not _keys_equal(_to_bytes(secret_key), self._secret_key):
                 return Response('Incorrect secret key', 403)
             return func(self, *args, **kwargs)
         return wrapper
     # pylint: enable=no-self-argument,protected-access
 
+    def _instance(self):
+        # One rule for both methods, so routing only has to match once
+        if request.method == 'POST':
+            return self._create_instance()
+        return self._status()
+
     @_check_running
     @_need_auth
     def _status(self):
@@ -87,7 +178,7 @@ class HttpServer(Flask):
     @_need_auth
     def _create_instance(self):
         try:
-            args = json.loads(request.data)
+            args = json_loads(request.data)
         except ValueError:
             return Response('Invalid request JSON', 400)
         try:
@@ -96,6 +187,27 @@ class HttpServer(Flask):
             return Response('Invalid or missing argument', 400)
         user_ident = args.get('user_ident')
 
+        package = self._get_package(url)
+        id, token = self._server.create_instance(package, user_ident)
+
+        r = self._url_prefix + token
+
+        _log.info("Preparing instance %s at %s", id, url)
+        return Response(_CREATE_RESPONSE % (json.dumps(r), json.dumps(id)),
+                mimetype='application/json')
+
+    def _get_package(self, url):
+        # Called from HTTP worker thread
+        now = time.time()
+        with self._package_lock:
+            try:
+                package, loaded = self._package_cache[url]
+                if now - loaded < PACKAGE_CACHE_TTL:
+                    return package
+            except KeyError:
+                pass
+
+        # Don't hold the lock while fetching the manifest
         username = self._options['username']
         password = self._options['password']
         try:
@@ -104,18 +216,16 @@ class HttpServer(Flask):
             source = source_open(url, scheme=e.scheme, username=username,
                     password=password)
         package = Package(source)
-        id, token = self._server.create_instance(package, user_ident)
-
-        host = self._options['host']
-        port = self._options['port']
-        hostname = host
-        if port != DEFAULT_PORT:
-            hostname += ':%d' % port
 
-        r = urlunsplit(('vmnetx', hostname, '/' + token, '', ''))
-
-        _log.info("Preparing instance %s at %s", id, url)
-        return jsonify(url=r, id=id)
+        with self._package_lock:
+            cache = self._package_cache
+            for cached_url, (_package, loaded) in cache.items():
+                if now - loaded >= PACKAGE_CACHE_TTL:
+                    del cache[cached_url]
+            if len(cache) >= PACKAGE_CACHE_SIZE and url not in cache:
+                del cache[min(cache, key=lambda u: cache[u][1])]
+            cache[url] = (package, now)
+        return package
 
     @_check_running
     @_need_auth
@@ -22,20 +22,69 @@ from dateutil.tz import tzutc
 import os
 import re
 import requests
+from threading import Thread
 from urllib import pathname2url
 from urlparse import urlsplit, urlunsplit
 
 from .util import NeedAuthentication, get_requests_session
 
+if hasattr(requests, 'adapters'):
+    # Don't read the response body until we've validated the response
+    _STREAM_ARGS = {'stream': True}
+else:
+    # requests < 1.0; the body is read eagerly
+    _STREAM_ARGS = {}
+
+_REALM_RE = re.compile('^realm="([^"]*)"$')
+
 class SourceError(Exception):
     '''_HttpSource would like to raise IOError on errors, but ZipFile swallows
     the error message.  So it raises this instead.'''
     pass
 
 
+class _Prefetch(object):
+    '''A range being fetched in the background.'''
+
+    def __init__(self, fetch, offset, size):
+        self.offset = offset
+        self._fetch = fetch
+        self._size = size
+        self._data = None
+        self._error = None
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._data = self._fetch(self.offset, self._size)
+        except SourceError, e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._data
+
+
 class _HttpSource(object):
     '''A read-only file-like object backed by HTTP Range requests.'''
 
+    # Ranges at least this large are split into PARALLEL_FETCHES pieces
+    # which are fetched concurrently
+    PARALLEL_THRESHOLD = 1 << 20
+    PARALLEL_FETCHES = 4
+    # The read-ahead window doubles on each sequential read which runs
+    # past the buffer, up to this size
+    MAX_WINDOW_SIZE = 1 << 20
+    # Number of earlier buffers to keep, and the largest buffer worth
+    # keeping.  zipfile moves back and forth between the central directory
+    # and the member it is reading.
+    CACHED_BUFFERS = 8
+    CACHED_BUFFER_MAX_SIZE = 256 << 10
+
     def __init__(self, url, scheme=None, username=None, password=None,
             buffer_size=64 << 10):
         if scheme == 'Basic':
@@ -50,10 +99,26 @@ class _HttpSource(object):
         self.url = url
         self._offset = 0
         self._closed = False
-        self._buffer = ''
+        # A memoryview, so that trimming the fetched data doesn't copy it
+        self._buffer = memoryview('')
         self._buffer_offset = 0
+        # Size of the fetch the buffer is a view of
+        self._buffer_fetch_size = 0
+        # (offset, memoryview, fetch size), oldest first
+        self._cached_buffers = []
         self._buffer_size = buffer_size
+        self._window = buffer_size
         self._session = get_requests_session()
+        if hasattr(requests, 'adapters'):
+            # Keep enough idle connections for a parallel fetch plus an
+            # abandoned prefetch still running alongside it
+            for prefix in ('http://', 'https://'):
+                self._session.mount(prefix, requests.adapters.HTTPAdapter(
+                        pool_connections=1,
+                        pool_maxsize=2 * self.PARALLEL_FETCHES))
+        # Background fetch of the region following the buffer, started
+        # by sequential reads
+        self._prefetch = None
 
         # Debugging
         self._last_case = None
@@ -73,7 +138,7 @@ class _HttpSource(object):
                             'authentication scheme: %s' % scheme)
                 host = urlsplit(self.url).netloc
                 for param in parameters.split(', '):
-                    match = re.match('^realm=\"([^"]*)\"$', param)
+                    match = _REALM_RE.match(param)
                     if match:
                         raise NeedAuthentication(host, match.group(1), scheme)
                 raise SourceError('Unknown authentication realm')
@@ -94,6 +159,13 @@ class _HttpSource(object):
             # Store validators
             self.etag = self._get_etag(resp)
             self.last_modified = self._get_last_modified(resp)
+            # Have the server refuse the range if the resource changes
+            if self.etag is not None:
+                self._if_range = self.etag
+            elif self.last_modified is not None:
+                self._if_range = resp.headers['Last-Modified']
+            else:
+                self._if_range = None
 
             # Record cookies
             if hasattr(self._session.cookies, 'extract_cookies'):
@@ -140,23 +212,152 @@ class _HttpSource(object):
             return None
 
     def _get(self, offset, size):
-        range = '%d-%d' % (offset, offset + size - 1)
-        self._last_network = range
-        range = 'bytes=' + range
-
+        self._last_network = '%d-%d' % (offset, offset + size - 1)
+        prefetch = self._prefetch
+        self._prefetch = None
+        if prefetch is not None and prefetch.offset == offset:
+            data = prefetch.result()
+            if len(data) >= size:
+                return data[:size]
+            if offset + len(data) >= self.length:
+                # Prefetch reached EOF
+                return data
+            return data + self._get_range(offset + len(data),
+                    size - len(data))
+        return self._get_range(offset, size)
+
+    def _start_prefetch(self, size):
+        # Fetch @size bytes following the buffer, for the next read that
+        # runs past it
+        offset = self._buffer_offset + len(self._buffer)
+        if offset < self.length:
+            self._prefetch = _Prefetch(self._get_range, offset, size)
+
+    def _get_range(self, offset, size):
+        # May be called from prefetch thread
+        if min(size, self.length - offset) < self.PARALLEL_THRESHOLD:
+            return self._fetch(offset, size)
+
+        # The server truncates ranges at EOF; do likewise so that no
+        # piece starts past the end
+        size = min(size, self.length - offset)
+        piece = -(-size // self.PARALLEL_FETCHES)
+        ranges = [(start, min(piece, offset + size - start))
+                for start in xrange(offset, offset + size, piece)]
+        results = [None] * len(ranges)
+        def fetch(i, start, count):
+            try:
+                results[i] = self._fetch(start, count)
+            except SourceError, e:
+                results[i] = e
+        threads = [Thread(target=fetch, args=(i, start, count))
+                for i, (start, count) in enumerate(ranges)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for result in results:
+            if isinstance(result, SourceError):
+                raise result
+        return bytearray().join(results)
+
+    def _request_range(self, offset, size):
+        # Returns a validated response whose body has not yet been read.
+        # The caller must close it.
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + size - 1)}
+        if self._if_range is not None:
+            headers['If-Range'] = self._if_range
+
+        resp = self._session.get(self.url, auth=self._auth,
+                headers=headers, **_STREAM_ARGS)
         try:
-            resp = self._session.get(self.url, auth=self._auth, headers={
-                'Range': range,
-            })
             resp.raise_for_status()
+            if resp.status_code == 200 and self._if_range is not None:
+                # Full response to an If-Range request.  Don't download
+                # the body.
+                raise SourceError('Resource changed on server')
             if resp.status_code != 206:
                 raise SourceError('Server ignored range request')
+            # In case the server ignored If-Range
             if (self._get_etag(resp) != self.etag or
                     self._get_last_modified(resp) != self.last_modified):
                 raise SourceError('Resource changed on server')
-            return resp.content
+        except Exception:
+            self._close_response(resp)
+            raise
+        return resp
+
+    def _close_response(self, resp):
+        if hasattr(resp, 'close'):
+            resp.close()
+
+    def _fetch(self, offset, size):
+        # May be called from multiple threads at once
+        # Returns a bytearray
+        try:
+            resp = self._request_range(offset, size)
+            try:
+                # Read the body directly into a preallocated buffer
+                buf = bytearray(size)
+                view = memoryview(buf)
+                count = 0
+                for chunk in resp.iter_content(64 << 10):
+                    if count + len(chunk) > size:
+                        raise SourceError('Server returned too much data')
+                    view[count:count + len(chunk)] = chunk
+                    count += len(chunk)
+                del view
+                del buf[count:]
+                return buf
+            finally:
+                self._close_response(resp)
+        except requests.exceptions.RequestException, e:
+            raise SourceError(str(e))
+
+    def copy_range_to(self, offset, length, fh, buf_size=1 << 20):
+        '''Copy length bytes starting at offset to fh.'''
+        if self.closed:
+            raise SourceError('File is closed')
+        # Stream the whole range with one request, bypassing the buffer
+        self._last_network = '%d-%d' % (offset, offset + length - 1)
+        count = 0
+        try:
+            resp = self._request_range(offset, length)
+            try:
+                for chunk in resp.iter_content(buf_size):
+                    if count + len(chunk) > length:
+                        raise SourceError('Server returned too much data')
+                    fh.write(chunk)
+                    count += len(chunk)
+            finally:
+                self._close_response(resp)
         except requests.exceptions.RequestException, e:
             raise SourceError(str(e))
+        if count < length:
+            raise SourceError('Server returned too little data')
+        self._offset = offset + length
+
+    def _retire_buffer(self):
+        # Called before the buffer is replaced
+        buf = self._buffer
+        fetch_size = self._buffer_fetch_size
+        if 0 < len(buf) <= self.CACHED_BUFFER_MAX_SIZE:
+            if fetch_size > 2 * len(buf):
+                # Copy, so we don't pin the rest of the fetch the buffer
+                # came from
+                buf = memoryview(buf.tobytes())
+                fetch_size = len(buf)
+            self._cached_buffers.append((self._buffer_offset, buf,
+                    fetch_size))
+            if len(self._cached_buffers) > self.CACHED_BUFFERS:
+                del self._cached_buffers[0]
+
+    def _find_cached_buffer(self, offset, size):
+        for i in xrange(len(self._cached_buffers) - 1, -1, -1):
+            buf_offset, buf, _fetch_size = self._cached_buffers[i]
+            if buf_offset <= offset and offset + size <= buf_offset + len(buf):
+                return self._cached_buffers.pop(i)
+        return None, None, None
 
     def read(self, size=None):
         if self.closed:
@@ -169,32 +370,61 @@ class _HttpSource(object):
             # Case B: Satisfy entirely from buffer
             self._last_case = 'B'
             start = self._offset - self._buffer_offset
-            ret = self._buffer[start:start + size]
-        elif self._offset >= buf_start and self._offset < buf_end:
+            ret = self._buffer[start:start + size].tobytes()
+            return self._advance(ret)
+
+        cached_offset, cached, cached_fetch_size = \
+                self._find_cached_buffer(self._offset, size)
+        if cached is not None:
+            # Case G: Satisfy entirely from an earlier buffer
+            # That buffer becomes current again
+            self._last_case = 'G'
+            self._retire_buffer()
+            self._buffer = cached
+            self._buffer_offset = cached_offset
+            self._buffer_fetch_size = cached_fetch_size
+            start = self._offset - cached_offset
+            ret = cached[start:start + size].tobytes()
+            return self._advance(ret)
+
+        if self._offset >= buf_start and self._offset < buf_end:
             # Case C: Satisfy head from buffer
-            # Buffer becomes _buffer_size bytes after requested region
+            # Buffer becomes _window bytes after requested region
             self._last_case = 'C'
-            ret = self._buffer[self._offset - buf_start:]
-            remaining = size - len(ret)
-            data = self._get(self._offset + len(ret), remaining +
-                    self._buffer_size)
-            ret += data[:remaining]
-            self._buffer = data[remaining:]
+            head = self._buffer[self._offset - buf_start:]
+            remaining = size - len(head)
+            data = self._get(self._offset + len(head), remaining +
+                    self._window)
+            view = memoryview(data)
+            ret = head.tobytes() + view[:remaining].tobytes()
+            self._buffer = view[remaining:]
             self._buffer_offset = self._offset + size
+            self._buffer_fetch_size = len(data)
+            # Sequential access; read further ahead next time, and start
+            # fetching it now
+            self._window = max(min(self._window * 2, self.MAX_WINDOW_SIZE),
+                    self._buffer_size)
+            self._start_prefetch(size + self._window)
         elif (self._offset < buf_start and
                 self._offset + size >= buf_start):
             # Case D: Satisfy tail from buffer
             # Buffer becomes _buffer_size bytes before requested region
             # plus requested region
             self._last_case = 'D'
+            self._retire_buffer()
+            self._window = self._buffer_size
             tail = self._buffer[:self._offset + size - buf_start]
             start = max(self._offset - self._buffer_size, 0)
             data = self._get(start, buf_start - start)
-            self._buffer = data + tail
+            data += tail
+            self._buffer = memoryview(data)
             self._buffer_offset = start
-            ret = self._buffer[self._offset - start:]
+            self._buffer_fetch_size = len(data)
+            ret = self._buffer[self._offset - start:].tobytes()
         else:
             # Buffer is useless
+            self._retire_buffer()
+            self._window = self._buffer_size
             if self._offset + size >= self.length:
                 # Case E: Reading at the end of the file.
                 # Assume zipfile is probing for the central directory.
@@ -202,18 +432,24 @@ class _HttpSource(object):
                 # region plus requested region
                 self._last_case = 'E'
                 start = max(self._offset - self._buffer_size, 0)
-                self._buffer = self._get(start,
-                        self._offset + size - start)
+                self._buffer = memoryview(self._get(start,
+                        self._offset + size - start))
                 self._buffer_offset = start
-                ret = self._buffer[self._offset - start:]
+                self._buffer_fetch_size = len(self._buffer)
+                ret = self._buffer[self._offset - start:].tobytes()
             else:
                 # Case F: Read unrelated to previous reads.
                 # Buffer becomes _buffer_size bytes after requested region
                 self._last_case = 'F'
                 data = self._get(self._offset, size + self._buffer_size)
-                ret = data[:size]
-                self._buffer = data[size:]
+                view = memoryview(data)
+                ret = view[:size].tobytes()
+                self._buffer = view[size:]
                 self._buffer_offset = self._offset + size
+                self._buffer_fetch_size = len(data)
+        return self._advance(ret)
+
+    def _advance(self, ret):
         self._offset += len(ret)
         return ret
 
@@ -235,7 +471,10 @@ class _HttpSource(object):
 
     def close(self):
         self._closed = True
-        self._buffer = ''
+        self._buffer = memoryview('')
+        self._buffer_fetch_size = 0
+        self._cached_buffers = []
+        self._prefetch = None
         self._session.close()
 
     @property
@@ -268,13 +507,44 @@ class _FileSource(file):
         self.last_modified = datetime.fromtimestamp(
                 int(os.fstat(self.fileno()).st_mtime), tzutc())
 
+    def copy_range_to(self, offset, length, fh, buf_size=1 << 20):
+        '''Copy length bytes starting at offset to fh.'''
+        # Read the descriptor directly rather than through stdio buffering
+        fd = self.fileno()
+        os.lseek(fd, offset, 0)
+        count = 0
+        try:
+            while count < length:
+                buf = os.read(fd, min(length - count, buf_size))
+                if not buf:
+                    raise IOError('Unexpected EOF')
+                fh.write(buf)
+                count += len(buf)
+        finally:
+            # Resynchronize the file object with the descriptor
+            self.seek(offset + count)
+
+
+_file_urls = {}  # absolute path -> file URL
+
+
+def _file_url(filename):
+    # Keyed by absolute path, since relative paths depend on the cwd
+    path = os.path.abspath(filename)
+    try:
+        return _file_urls[path]
+    except KeyError:
+        if len(_file_urls) >= 256:
+            _file_urls.clear()
+        url = _file_urls[path] = urlunsplit(('file', '', pathname2url(path),
+                '', ''))
+        return url
+
 
 def source_open(url=None, scheme=None, username=None, password=None,
         filename=None):
     if filename:
-        url = urlunsplit(('file', '',
-                pathname2url(os.path.abspath(filename)), '', ''))
-        return _FileSource(url)
+        return _FileSource(_file_url(filename))
     else:
         parsed = urlsplit(url)
         if parsed.scheme == 'http' or parsed.scheme == 'https':
@@ -307,6 +577,8 @@ class SourceRange(object):
     def write_to_file(self, fh, buf_size=1 << 20):
         if self.data is not None:
             fh.write(self.data)
+        elif hasattr(self.source, 'copy_range_to'):
+            self.source.copy_range_to(self.offset, self.length, fh, buf_size)
         else:
             self.source.seek(self.offset)
             count = self.length
@@ -376,9 +648,13 @@ def _main():
                     len(data) - 9, '43-51')
 
             # Zero-length read
-            fh.seek(0)
-            try_read(fh, 0, 'F', '', 0, data[0:4], 0, '0-3')
-            try_read(fh, 0, 'B', '', 0, data[0:4], 0)
+            fh.seek(31)
+            try_read(fh, 0, 'F', '', 31, data[31:35], 31, '31-34')
+            try_read(fh, 0, 'B', '', 31, data[31:35], 31)
+
+            # Case G
+            fh.seek(3)
+            try_read(fh, 4, 'G', data[3:7], 7, data[0:22], 0)
 
         with _HttpSource('http://localhost:8080/test.txt',
                 buffer_size=4) as fh:
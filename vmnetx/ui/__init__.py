@@ -16,15 +16,19 @@
 #
 
 from datetime import date, datetime, timedelta
-import dateutil.parser
-from distutils.version import LooseVersion
 import glib
 import gobject
 import gtk
-import json
+try:
+    # Faster, if available.  Output is compact by default.
+    from ujson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as _json_dumps, loads as json_loads
+    def json_dumps(obj):
+        return _json_dumps(obj, separators=(',', ':'))
 import logging
 import os
-import requests
+import re
 import signal
 import sys
 from tempfile import NamedTemporaryFile
@@ -49,45 +53,146 @@ else:
 
 _log = logging.getLogger(__name__)
 
+_ZERO_BLOCK = '\0' * 65536
+
+
+def _is_zero(buf):
+    # Probe a sample of bytes spread across the buffer first, since a
+    # screen that isn't black may still have a large black area at the top
+    sample = buf[::max(1, len(buf) // 64)]
+    if sample.count('\0') != len(sample):
+        return False
+    # Compare block by block with memcmp, stopping at the first block
+    # containing a nonzero byte, without allocating
+    step = len(_ZERO_BLOCK)
+    end = len(buf) - len(buf) % step
+    for offset in xrange(0, end, step):
+        if not buf.startswith(_ZERO_BLOCK, offset):
+            return False
+    return buf.count('\0', end) == len(buf) - end
+
+
+# Same components as distutils.version.LooseVersion
+_VERSION_COMPONENT_RE = re.compile(r'(\d+|[a-z]+|\.)')
+
+
+def _version_key(version):
+    # Return a tuple which compares like LooseVersion(version)
+    return tuple(int(c) if c.isdigit() else c
+            for c in _VERSION_COMPONENT_RE.split(version)
+            if c and c != '.')
+
+
+_OUR_VERSION = _version_key(__version__)
+
+
 class _StateCache(object):
-    def __init__(self, filename):
+    # All sections are stored in one file, keyed by section name
+    FILENAME = 'state'
+
+    def __init__(self, section):
         self._cachedir = get_cache_dir()
-        self._path = os.path.join(self._cachedir, filename)
+        self._path = os.path.join(self._cachedir, self.FILENAME)
+        self._section = section
+        # Older versions stored each section in a file named after it
+        self._legacy_path = os.path.join(self._cachedir, section)
+        # Parsed contents of the file, and the stat key they correspond to
+        self._cached = None
+        self._cached_key = None
+
+    def _stat_key(self):
+        # _save() replaces the file by rename, so the inode number changes
+        # on every write
+        st = os.stat(self._path)
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _load_root(self):
+        try:
+            key = self._stat_key()
+        except OSError:
+            self._cached = self._cached_key = None
+            return {}
+        if key == self._cached_key:
+            return self._cached
+        try:
+            with open(self._path) as fh:
+                root = json_loads(fh.read())
+        except IOError:
+            return {}
+        self._cached = root
+        self._cached_key = key
+        return root
 
     def _load(self):
+        # Callers that modify the returned map must _save() it
         try:
-            with open(self._path) as fh:
-                return json.load(fh)
+            return self._load_root()[self._section]
+        except KeyError:
+            pass
+        # Not yet migrated into the combined file
+        try:
+            with open(self._legacy_path) as fh:
+                return json_loads(fh.read())
         except IOError:
             return {}
 
     def _save(self, map):
+        # Start from the current file contents, so we don't clobber other
+        # sections
+        root = self._load_root()
+        root[self._section] = map
         with NamedTemporaryFile(dir=self._cachedir, delete=False) as fh:
-            json.dump(map, fh)
+            fh.write(json_dumps(root))
             fh.write('\n')
         rename(fh.name, self._path)
+        try:
+            self._cached_key = self._stat_key()
+            self._cached = root
+        except OSError:
+            self._cached = self._cached_key = None
 
 
 class _UsernameCache(_StateCache):
     def __init__(self):
         _StateCache.__init__(self, 'usernames')
+        # Usernames not yet written to disk
+        self._pending = {}
 
     def get(self, host, realm):
+        try:
+            return self._pending[(host, realm)]
+        except KeyError:
+            pass
         try:
             return self._load()[host][realm]
         except KeyError:
             return None
 
     def put(self, host, realm, username):
+        # Coalesce repeated authentication attempts into a single write
+        # at flush()
+        self._pending[(host, realm)] = username
+
+    def flush(self):
+        if not self._pending:
+            return
         map = self._load()
-        map.setdefault(host, {})[realm] = username
-        self._save(map)
+        changed = False
+        for (host, realm), username in self._pending.iteritems():
+            realms = map.setdefault(host, {})
+            if realms.get(realm) != username:
+                realms[realm] = username
+                changed = True
+        self._pending = {}
+        if changed:
+            self._save(map)
 
 
 class _UpdateState(_StateCache):
     DISABLED = 'disabled'
     IGNORE = 'ignore'
     NEXT_CHECK = 'next-check'
+    CHECK_TIMEOUT = 5  # seconds
 
     def __init__(self, defer_days):
         _StateCache.__init__(self, 'update-checking')
@@ -96,26 +201,37 @@ class _UpdateState(_StateCache):
         self.current_version = None
         self.release_date = None
         self._update_url = None
+        self._map = None
+
+    def _get_map(self):
+        # Load the state once and keep modifying the same map
+        if self._map is None:
+            self._map = self._load()
+        return self._map
 
     def check_for_update(self):
         if not update_check_url:
             return
-
-        map = self._load()
+        map = self._get_map()
         if map.get(self.DISABLED):
             return
         next_check = map.get(self.NEXT_CHECK, '2000-01-01')
         try:
-            if dateutil.parser.parse(next_check) > datetime.now():
+            # We wrote this ourselves with date.isoformat()
+            if datetime.strptime(next_check, '%Y-%m-%d') > datetime.now():
                 return
         except (TypeError, ValueError):
             pass
 
+        # Import update-check dependencies only when they are needed
+        import dateutil.parser
+        import requests
         try:
             sesn = get_requests_session()
-            req = sesn.get(update_check_url)
+            # Don't hold up startup if the update server is unresponsive
+            req = sesn.get(update_check_url, timeout=self.CHECK_TIMEOUT)
             req.raise_for_status()
-            info = json.loads(req.text)
+            info = json_loads(req.content)
             self.current_version = info['version']
             self.release_date = dateutil.parser.parse(info['release-date'])
             self._update_url = info['update-url']
@@ -126,28 +242,37 @@ class _UpdateState(_StateCache):
             return
 
         if (self.current_version != map.get(self.IGNORE) and
-                LooseVersion(self.current_version) >
-                LooseVersion(__version__)):
+                _version_key(self.current_version) > _OUR_VERSION):
             self.have_update = True
         else:
             self.defer_update()
 
     def _defer_update(self, map):
-        map[self.NEXT_CHECK] = (date.today() +
+        # Return True if the map was changed
+        changed = False
+        next_check = (date.today() +
                 timedelta(days=self._defer_days)).isoformat()
+        if map.get(self.NEXT_CHECK) != next_check:
+            map[self.NEXT_CHECK] = next_check
+            changed = True
         if self.IGNORE in map and self.current_version != map[self.IGNORE]:
             del map[self.IGNORE]
+            changed = True
+        return changed
 
     def defer_update(self):
-        map = self._load()
-        self._defer_update(map)
-        self._save(map)
+        map = self._get_map()
+        if self._defer_update(map):
+            self._save(map)
 
     def skip_release(self):
-        map = self._load()
-        self._defer_update(map)
-        map[self.IGNORE] = self.current_version
-        self._save(map)
+        map = self._get_map()
+        changed = self._defer_update(map)
+        if map.get(self.IGNORE) != self.current_version:
+            map[self.IGNORE] = self.current_version
+            changed = True
+        if changed:
+            self._save(map)
 
     def update(self):
         open_browser(self._update_url)
@@ -156,6 +281,7 @@ class _UpdateState(_StateCache):
 class VMNetXUI(object):
     UPDATE_DEFER_DAYS = 7
     RESUME_CHECK_DELAY = 1000  # ms
+    RESUME_CHECK_MAX_DELAY = 10000  # ms
 
     def __init__(self, package_ref):
         gobject.threads_init()
@@ -169,6 +295,7 @@ class VMNetXUI(object):
         self._shutting_down = False
         self._io_failed = False
         self._check_display = False
+        self._check_delay = self.RESUME_CHECK_DELAY
         self._bad_memory = False
         self._update = _UpdateState(self.UPDATE_DEFER_DAYS)
         self._update_wind = None
@@ -231,10 +358,17 @@ class VMNetXUI(object):
                     self._controller.username = pw_wind.username
                     self._controller.password = pw_wind.password
                     self._username_cache.put(e.host, e.realm, pw_wind.username)
+                except Exception:
+                    # The server didn't reject the credentials, but a
+                    # later setup step failed.  Remember the username
+                    # anyway.
+                    self._username_cache.flush()
+                    raise
                 else:
                     if pw_wind is not None:
                         pw_wind.destroy()
                     break
+            self._username_cache.flush()
 
             # Show main window
             self._wind = VMWindow(self._controller.vm_name,
@@ -256,7 +390,7 @@ class VMNetXUI(object):
             # Start logging
             logging.getLogger().setLevel(logging.INFO)
             _log.info('VMNetX %s starting at %s', __version__,
-                    datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                    time.strftime('%Y-%m-%d %H:%M:%S'))
 
             # Run main loop
             gtk.main()
@@ -342,7 +476,8 @@ class VMNetXUI(object):
     def _connect(self, _obj):
         if self._check_display:
             self._check_display = False
-            glib.timeout_add(self.RESUME_CHECK_DELAY,
+            self._check_delay = self.RESUME_CHECK_DELAY
+            glib.timeout_add(self._check_delay,
                     self._startup_check_screenshot)
 
     def _startup_check_screenshot(self):
@@ -350,10 +485,13 @@ class VMNetXUI(object):
         # than failing properly.  Recover from this case.
         img = self._wind.take_screenshot()
         if img is None:
+            # No frame yet.  Try again later, backing off exponentially.
+            self._check_delay *= 2
+            if self._check_delay <= self.RESUME_CHECK_MAX_DELAY:
+                glib.timeout_add(self._check_delay,
+                        self._startup_check_screenshot)
             return
-        black = ('\0' * (img.get_n_channels() * img.get_width() *
-                img.get_height() * img.get_bits_per_sample() // 8))
-        if img.get_pixels() == black:
+        if _is_zero(img.get_pixels()):
             _log.warning('Detected black screen; assuming bad memory image')
             self._warn_bad_memory()
             # Terminate the VM; the vm-stopped handler will restart it
@@ -22,6 +22,7 @@ import glib
 import gobject
 from gobject import GObject
 import gtk
+from itertools import groupby
 import logging
 import math
 import pango
@@ -93,6 +94,9 @@ class SpiceWidget(gtk.EventBox):
     }
 
     BACKOFF_TIMES = (1000, 2000, 5000, 10000)  # ms
+    # Spread out reconnects from viewers that lost their connections at
+    # the same time
+    BACKOFF_JITTER = 0.5
     ERROR_EVENTS = set([
         SpiceClientGtk.CHANNEL_CLOSED,
         SpiceClientGtk.CHANNEL_ERROR_AUTH,
@@ -116,8 +120,11 @@ class SpiceWidget(gtk.EventBox):
         self._accept_next_mouse_event = False
         self._password = None
         self._want_reconnect = False
-        self._backoff = BackoffTimer()
+        self._backoff = BackoffTimer(self.BACKOFF_TIMES,
+                jitter=self.BACKOFF_JITTER)
         self._last_motion_time = 0
+        self._pending_motion = None
+        self._pending_motion_source = None
         if max_mouse_rate is not None:
             self._motion_interval = 1000 // max_mouse_rate  # ms
         else:
@@ -261,15 +268,40 @@ class SpiceWidget(gtk.EventBox):
             self._accept_next_mouse_event = False
             return False
         elif motion.time < self._last_motion_time + self._motion_interval:
-            # Motion event came too soon; ignore it
+            # Motion event came too soon; ignore it.  But if it turns out
+            # to be the last one, replay it later so the final pointer
+            # position isn't lost.
+            self._pending_motion = motion.copy()
+            if self._pending_motion_source is None:
+                self._pending_motion_source = glib.timeout_add(
+                        self._last_motion_time + self._motion_interval -
+                        motion.time, self._replay_motion)
             return True
         else:
             # Accept motion
+            self._cancel_pending_motion()
             self._last_motion_time = motion.time
             self._accept_next_mouse_event = True
             return False
 
+    def _replay_motion(self):
+        self._pending_motion_source = None
+        motion = self._pending_motion
+        self._pending_motion = None
+        if self._display is not None:
+            # Ensure the rate limit lets it through
+            self._last_motion_time = motion.time - self._motion_interval
+            self._display.event(motion)
+        return False
+
+    def _cancel_pending_motion(self):
+        if self._pending_motion_source is not None:
+            glib.source_remove(self._pending_motion_source)
+            self._pending_motion_source = None
+        self._pending_motion = None
+
     def _destroy_display(self):
+        self._cancel_pending_motion()
         if self._display is not None:
             self._display.destroy()
             self._display = None
@@ -651,6 +683,10 @@ class ImageChunkWidget(gtk.DrawingArea):
         ChunkStateArray.MODIFIED: cairo.SolidPattern(.45, 0, 0),
         ChunkStateArray.ACCESSED_MODIFIED: cairo.SolidPattern(1, 0, 0),
     }
+    # Indexed by state, for _draw_chunks.  The states must be numbered
+    # contiguously from zero.
+    PATTERN_TABLE = tuple(map(PATTERNS.__getitem__, xrange(max(PATTERNS) + 1)))
+    assert len(PATTERN_TABLE) == len(PATTERNS)
 
     TIP = """Red: Accessed and modified this session
 White: Accessed this session
@@ -658,40 +694,73 @@ Dark red: Modified this session
 Light gray: Fetched in previous session
 Dark gray: Not present"""
 
+    # The chunk map is cached as a stack of off-screen tiles this many
+    # rows high, rendered as they are exposed
+    TILE_HEIGHT = 256
+    # Tiles kept beyond those currently exposed are discarded, nearest last
+    CACHED_TILES = 16
+    # cairo refuses image surfaces larger than this in either dimension
+    MAX_SURFACE_SIZE = 32767
+
     def __init__(self, chunk_map):
         gtk.DrawingArea.__init__(self)
         self._map = chunk_map
         self._map_chunk_handler = None
+        self._map_ranges_handler = None
         self._map_resize_handler = None
         self._width_history = [0, 0]
+        self._dirty_region = None
+        self._flush_source = None
+        # Off-screen rendering of the chunk map, updated incrementally:
+        # tile index -> cairo.ImageSurface
+        self._tiles = {}
+        self._tile_width = None
+        self._row_width = 1
+        self._valid_rows = 0
         self.set_tooltip_text(self.TIP)
         self.connect('realize', self._realize)
         self.connect('unrealize', self._unrealize)
         self.connect('configure-event', self._configure)
         self.connect('expose-event', self._expose)
 
-    # pylint doesn't understand allocation.width
-    # pylint: disable=no-member
     @property
     def valid_rows(self):
         """Return the number of rows where at least one pixel corresponds
         to a chunk."""
-        row_width = self.allocation.width
-        return (len(self._map) + row_width - 1) // row_width
-    # pylint: enable=no-member
+        return self._valid_rows
 
+    def _update_geometry(self, row_width):
+        # Cache the row width and valid row count, so the redraw and
+        # invalidation paths don't have to recompute them
+        self._row_width = row_width
+        self._valid_rows = (len(self._map) + row_width - 1) // row_width
+
+    # pylint doesn't understand allocation.width
+    # pylint: disable=no-member
     def _realize(self, _widget):
+        # The image may have been resized while we were unrealized
+        self._update_geometry(self.allocation.width)
         self._map_chunk_handler = self._map.connect('chunk-state-changed',
                 self._chunk_changed)
+        self._map_ranges_handler = self._map.connect('chunk-ranges-changed',
+                self._chunks_changed)
         self._map_resize_handler = self._map.connect('image-resized',
                 self._image_resized)
         self.queue_resize_no_redraw()
+    # pylint: enable=no-member
 
     def _unrealize(self, _widget):
         self._map.disconnect(self._map_chunk_handler)
+        self._map.disconnect(self._map_ranges_handler)
         self._map.disconnect(self._map_resize_handler)
+        if self._flush_source is not None:
+            glib.source_remove(self._flush_source)
+            self._flush_source = None
+        self._dirty_region = None
+        self._tiles = {}
 
     def _configure(self, _widget, event):
+        self._update_geometry(event.width)
         self._width_history.append(event.width)
         if (self._width_history.pop(0) == event.width and
                 abs(self._width_history[0] - event.width) > 10):
@@ -708,19 +777,59 @@ Dark gray: Not present"""
     # pylint doesn't understand allocation.width or window.cairo_create()
     # pylint: disable=no-member
     def _expose(self, _widget, event):
+        area = event.area
+        cr = self.window.cairo_create()
+        width = self._row_width
+        if width > self.MAX_SURFACE_SIZE:
+            # Too wide to cache
+            self._draw_chunks(cr, area.x, area.y, area.width, area.height)
+            return
+        if width != self._tile_width:
+            self._tiles = {}
+            self._tile_width = width
+
+        # Copy the exposed area from the tiles covering it
+        cr.rectangle(area.x, area.y, area.width, area.height)
+        cr.clip()
+        first = area.y // self.TILE_HEIGHT
+        last = (area.y + area.height - 1) // self.TILE_HEIGHT
+        for index in xrange(first, last + 1):
+            top = index * self.TILE_HEIGHT
+            cr.set_source_surface(self._get_tile(index), 0, top)
+            cr.rectangle(0, top, width, self.TILE_HEIGHT)
+            cr.fill()
+
+        # Bound the cache by dropping the tiles furthest from this area
+        if len(self._tiles) > self.CACHED_TILES:
+            for index in sorted(self._tiles,
+                    key=lambda i: abs(i - first))[self.CACHED_TILES:]:
+                if index < first or index > last:
+                    del self._tiles[index]
+
+    def _get_tile(self, index):
+        """Return the cached rendering of tile @index, rendering it if
+        necessary."""
+        tile = self._tiles.get(index)
+        if tile is None:
+            top = index * self.TILE_HEIGHT
+            tile = cairo.ImageSurface(cairo.FORMAT_RGB24, self._tile_width,
+                    self.TILE_HEIGHT)
+            cr = cairo.Context(tile)
+            cr.translate(0, -top)
+            self._draw_chunks(cr, 0, top, self._tile_width, self.TILE_HEIGHT)
+            self._tiles[index] = tile
+        return tile
+
+    def _draw_chunks(self, cr, area_x, area_y, area_width, area_height):
         # This function is optimized; be careful when changing it.
         # Localize variables for performance (!!)
-        patterns = self.PATTERNS
+        patterns = self.PATTERN_TABLE
         chunk_states = self._map
-        chunks = len(chunk_states)
-        area_x, area_y, area_height, area_width = (event.area.x,
-                event.area.y, event.area.height, event.area.width)
-        row_width = self.allocation.width
-        valid_rows = self.valid_rows
+        row_width = self._row_width
+        valid_rows = self._valid_rows
         default_state = ChunkStateArray.MISSING
         invalid_state = ChunkStateArray.INVALID
 
-        cr = self.window.cairo_create()
         set_source = cr.set_source
         rectangle = cr.rectangle
         fill = cr.fill
@@ -741,39 +850,91 @@ Dark gray: Not present"""
 
         # Fill in valid rows.  Avoid drawing MISSING chunks, since those
         # are handled by the background fill.  Combine adjacent pixels
-        # of the same color on the same line into a single rectangle.
-        last_state = None
+        # of the same color on the same line into a single rectangle,
+        # letting groupby() find the runs.  Collect the rectangles by
+        # color, then draw each color as a single path with one fill.
+        rects = [[] for _ in patterns]
+        x_end = area_x + area_width
+        first_chunk = area_y * row_width + area_x
         for y in xrange(area_y, min(area_y + area_height, valid_rows)):
-            first_x = area_x
-            for x in xrange(area_x, area_x + area_width):
-                chunk = y * row_width + x
-                if chunk < chunks:
-                    state = chunk_states[chunk]
-                else:
-                    state = invalid_state
-                if state != last_state:
-                    if x > first_x and last_state != default_state:
-                        rectangle(first_x, y, x - first_x, 1)
-                        fill()
-                    set_source(patterns[state])
-                    first_x = x
-                    last_state = state
-            if state != default_state:
-                rectangle(first_x, y, area_x + area_width - first_x, 1)
+            x = area_x
+            for state, run in groupby(chunk_states[first_chunk:
+                    first_chunk + area_width]):
+                count = len(list(run))
+                if state != default_state:
+                    rects[state].append((x, y, count, 1))
+                x += count
+            if x < x_end:
+                # Past the end of the image
+                rects[invalid_state].append((x, y, x_end - x, 1))
+            first_chunk += row_width
+        for state, state_rects in enumerate(rects):
+            if state_rects:
+                set_source(patterns[state])
+                for rect in state_rects:
+                    rectangle(*rect)
                 fill()
     # pylint: enable=no-member
 
     # pylint doesn't understand allocation.width
     # pylint: disable=no-member
-    def _chunk_changed(self, _map, first, last):
-        width = self.allocation.width
-        for row in xrange(first // width, last // width + 1):
-            row_first = max(width * row, first) % width
-            row_last = min(width * (row + 1) - 1, last) % width
-            self.queue_draw_area(row_first, row, row_last - row_first + 1, 1)
+    def _chunk_changed(self, chunk_map, first, last):
+        self._chunks_changed(chunk_map, ((first, last),))
+
+    def _chunks_changed(self, _map, ranges):
+        # Invalidate at most three rectangles per range: the partial first
+        # row, the full rows in between, and the partial last row.
+        # Accumulate them in a dirty region which is flushed once per main
+        # loop iteration, so a burst of chunk updates produces one
+        # invalidation.
+        width = self._row_width
+        if self._dirty_region is None:
+            self._dirty_region = gtk.gdk.Region()
+        union = self._dirty_region.union_with_rect
+        for first, last in ranges:
+            first_row, first_col = divmod(first, width)
+            last_row, last_col = divmod(last, width)
+            if first_row == last_row:
+                union(gtk.gdk.Rectangle(first_col, first_row,
+                        last_col - first_col + 1, 1))
+                continue
+            union(gtk.gdk.Rectangle(first_col, first_row,
+                    width - first_col, 1))
+            if last_row > first_row + 1:
+                union(gtk.gdk.Rectangle(0, first_row + 1, width,
+                        last_row - first_row - 1))
+            union(gtk.gdk.Rectangle(0, last_row, last_col + 1, 1))
+        if self._flush_source is None:
+            self._flush_source = glib.idle_add(self._flush_dirty)
+
+    def _flush_dirty(self):
+        # Bring the cached tiles up to date, then invalidate
+        if self._tile_width != self._row_width:
+            self._tiles = {}
+        tile_height = self.TILE_HEIGHT
+        for rect in self._dirty_region.get_rectangles():
+            bottom = rect.y + rect.height
+            for index in xrange(rect.y // tile_height,
+                    (bottom - 1) // tile_height + 1):
+                tile = self._tiles.get(index)
+                if tile is None:
+                    continue
+                top = index * tile_height
+                cr = cairo.Context(tile)
+                cr.translate(0, -top)
+                area_y = max(rect.y, top)
+                self._draw_chunks(cr, rect.x, area_y, rect.width,
+                        min(bottom, top + tile_height) - area_y)
+        self.window.invalidate_region(self._dirty_region, False)
+        self._dirty_region = None
+        self._flush_source = None
+        return False
     # pylint: enable=no-member
 
     def _image_resized(self, _map, _chunks):
+        # The chunk-state-changed emission that follows covers every
+        # chunk affected by the resize, so the tiles can be kept
+        self._update_geometry(self._row_width)
         self.queue_resize_no_redraw()
 
 
@@ -789,6 +950,8 @@ class ScrollingImageChunkWidget(gtk.ScrolledWindow):
 
 class StatWidget(gtk.EventBox):
     ACTIVITY_FLAG = gtk.gdk.Color('#ff4040')
+    UPDATE_INTERVAL = 16  # ms
+    FLAG_DURATION = 100  # ms
 
     def __init__(self, stat, chunk_size=None, tooltip=None):
         gtk.EventBox.__init__(self)
@@ -802,6 +965,9 @@ class StatWidget(gtk.EventBox):
         if tooltip:
             self.set_tooltip_text(tooltip)
         self._timer = None
+        self._flag_expires = 0
+        self._pending_value = None
+        self._update_timer = None
         self.connect('realize', self._realize)
         self.connect('unrealize', self._unrealize)
 
@@ -811,26 +977,45 @@ class StatWidget(gtk.EventBox):
 
     def _unrealize(self, _widget):
         self._stat.disconnect(self._stat_handler)
+        if self._update_timer is not None:
+            glib.source_remove(self._update_timer)
+            self._update_timer = None
 
     def _format(self, value):
         """Override this in subclasses."""
         return str(value)
 
     def _changed(self, _stat, _name, value):
-        new = self._format(value)
+        # Stats can change hundreds of times per second.  Update the
+        # display at most once per frame.
+        self._pending_value = value
+        if self._update_timer is None:
+            self._update_timer = glib.timeout_add(self.UPDATE_INTERVAL,
+                    self._update)
+
+    def _update(self):
+        self._update_timer = None
+        new = self._format(self._pending_value)
         if self._label.get_text() != new:
             # Avoid unnecessary redraws
             self._label.set_text(new)
 
-        # Update activity flag
+        # Update activity flag.  Rather than re-arming the timer on every
+        # update, push back the expiration time and let the running
+        # timer reschedule itself.
+        self._flag_expires = time.time() + self.FLAG_DURATION / 1000
         if self._timer is None:
             self.modify_bg(gtk.STATE_NORMAL, self.ACTIVITY_FLAG)
-        else:
-            # Clear timer before setting a new one
-            glib.source_remove(self._timer)
-        self._timer = glib.timeout_add(100, self._clear_flag)
+            self._timer = glib.timeout_add(self.FLAG_DURATION,
+                    self._clear_flag)
+        return False
 
     def _clear_flag(self):
+        remaining = self._flag_expires - time.time()
+        if remaining > 0:
+            self._timer = glib.timeout_add(int(math.ceil(remaining * 1000)),
+                    self._clear_flag)
+            return False
         self.modify_bg(gtk.STATE_NORMAL, None)
         self._timer = None
         return False
@@ -17,6 +17,7 @@
 
 import gobject
 import os
+import random
 import socket
 import subprocess
 import sys
@@ -86,21 +87,51 @@ class RangeConsolidator(object):
                 self._callback(self._first, self._last)
             self._first = self._last = value
 
+    def emit_many(self, values):
+        # Equivalent to calling emit() on each value, with the run
+        # tracking kept in locals
+        callback = self._callback
+        first = self._first
+        last = self._last
+        for value in values:
+            if last == value - 1:
+                last = value
+            else:
+                if first is not None:
+                    callback(first, last)
+                first = last = value
+        self._first = first
+        self._last = last
+
     def __exit__(self, _exc_type, _exc_val, _exc_tb):
         if self._first is not None:
             self._callback(self._first, self._last)
         return False
 
 
+def connect_signals(obj, handlers):
+    '''Connect each (signal, handler) pair in handlers to obj.  Return the
+    handler IDs, as a tuple, for use with disconnect_signals().'''
+    return tuple(obj.connect(signal, handler) for signal, handler in handlers)
+
+
+def disconnect_signals(obj, handler_ids):
+    for handler_id in handler_ids:
+        obj.disconnect(handler_id)
+
+
 class BackoffTimer(gobject.GObject):
     __gsignals__ = {
         'attempt': (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
     }
 
-    def __init__(self, schedule=(1000, 2000, 5000, 10000)):
-        # schedule is in ms
+    def __init__(self, schedule=(1000, 2000, 5000, 10000), jitter=0):
+        # schedule is in ms.  Each delay is randomly shortened by up to
+        # the jitter fraction, so that many clients disconnected at the
+        # same time don't all retry in lockstep.
         gobject.GObject.__init__(self)
         self._schedule = schedule
+        self._jitter = jitter
         self._schedule_index = None
         self._timer = None
 
@@ -113,7 +144,8 @@ class BackoffTimer(gobject.GObject):
             self._schedule_index = 0
             self._timer = gobject.idle_add(self._attempt)
         else:
-            timeout = self._schedule[self._schedule_index]
+            timeout = int(self._schedule[self._schedule_index] *
+                    (1 - self._jitter * random.random()))
             self._schedule_index = min(self._schedule_index + 1,
                     len(self._schedule) - 1)
             self._timer = gobject.timeout_add(timeout, self._attempt)